@@ -1,2 +1,4 @@
 from .openmetra import OpenMetra
 from .openmetra import VERSION
+from .metradb import MetraDB
+from .metrafile import MetraFile
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+import numpy as np;
+
+from .openmetra import OpenMetra
+
+
+class MetraBulk:
+    '''Offline decoder for raw BD232 byte captures
+
+    Decodes a complete capture at once with numpy array operations instead of
+    feeding it byte by byte through the state machine of OpenMetra.
+    The result is identical to a sequence of OpenMetra.get_measurement() calls
+    on a freshly opened connection (without warm start cache),
+    incomplete blocks (where get_measurement() returns False) are not returned.
+
+    1. mask all bytes with 0x3F, find the candidates for block start
+       (device code in known_devices or 0x1x for fast mode),
+    2. classify the blocks (TM1a, TM1b, TM2, incomplete) and get their length
+       from the bytes at fixed offsets,
+    3. select the blocks the state machine really sees - a candidate inside
+       a previous block is skipped,
+    4. propagate the instrument settings of the status blocks to the following
+       fast mode blocks and apply the decimal point rules and overload detection.
+    '''
+
+    #######################
+    # the class variables #
+    #######################
+
+    FRAME_TM1A = 0              # fast mode value block
+    FRAME_TM1B = 1              # fast mode settings block, followed by value
+    FRAME_TM2 = 2               # slow mode block with settings and value
+
+    _MAX_ITERATIONS = 32        # block selection: switch to sequential loop for garbage data
+
+
+    #######################
+    # the class interface #
+    #######################
+
+    @classmethod
+    def decode( cls, data, known_devices = [ OpenMetra.METRAHIT28S, OpenMetra.METRAHIT29S ] ):
+        '''Decode a raw capture (bytes, bytearray or numpy array) and return a dict of numpy arrays,
+        one entry per measurement:
+        "pos": offset of block start, "kind": FRAME_TM1A, FRAME_TM1B or FRAME_TM2,
+        "text": value string as returned by get_measurement() (None: overload),
+        "value": value as float (nan: overload), "overload": True on overload,
+        "model", "ctmv" (-1: not yet seen), "rs", "special", "rate": instrument settings,
+        "unit", "unit_long": unit strings as returned by get_unit() and get_unit_long()'''
+        raw = np.asarray( bytearray( data ) if isinstance( data, ( bytes, bytearray ) ) else data, dtype = np.uint8 )
+        size = len( raw )
+        # pad with digit bytes, blocks reaching into the padding are dropped at the end
+        b = np.concatenate( ( raw & 0x3F, np.full( 13, 0x30, dtype = np.uint8 ) ) ).astype( np.int64 )
+        digit = b & 0x0F
+        # _get_digit() flags an unexpected start byte, count them for range checks
+        unexpected = np.concatenate( ( [ 0 ], np.cumsum( b < 0x30 ) ) )
+
+        def flagged( pos, first, last ):
+            'True if any byte at pos+first .. pos+last is < 0x30'
+            return unexpected[ pos + last + 1 ] - unexpected[ pos + first ] > 0
+
+        # 1. start candidates, see _start_detected()
+        start = b[ : size ]
+        pos = np.flatnonzero( np.isin( start, known_devices ) | ( start & 0x30 == 0x10 ) )
+
+        # 2. classify and get the length, see _get_value()
+        status = b[ pos ] < 0x10                        # TM1b or TM2 (device code)
+        slow = status & ( b[ pos + 5 ] >= 0x30 )        # TM2
+        fail_5 = flagged( pos, 1, 4 )                   # error in status bytes 2..5
+        fail_11 = flagged( pos, 6, 10 )                 # error in digits of TM1b or TM2
+        fail_13 = flagged( pos, 11, 12 )                # error in byte 12, 13 of TM2
+        length = np.where( status, np.where( fail_5, 6, np.where( slow & ~fail_11, 13, 11 ) ), 6 )
+        fail = np.where( status, fail_5 | fail_11 | ( slow & fail_13 ), flagged( pos, 1, 5 ) )
+        reached_13 = slow & ~fail_5 & ~fail_11          # got byte 12 and 13 (ctmv msb, rate)
+
+        # 3. select the blocks that are really read, a candidate inside a block is skipped
+        valid = cls._select( pos, pos + length )
+        end = pos + length
+        valid &= end <= size                            # the stream ends inside the block
+        pos, status, slow, fail, reached_13 = ( a[ valid ] for a in ( pos, status, slow, fail, reached_13 ) )
+        index = np.arange( len( pos ) )
+
+        # 4. instrument settings, valid from status block until next status block
+        # also incomplete status blocks change the settings
+        last_status = np.maximum.accumulate( np.where( status, index, -1 ) )
+        seen = last_status >= 0
+        ls = np.maximum( last_status, 0 )
+        ctmv = digit[ pos + 1 ] + np.where( reached_13, digit[ pos + 11 ] << 4, 0 )
+        ctmv = np.where( seen, ctmv[ ls ], -1 )
+        model = np.where( seen, b[ pos ][ ls ], 0 )
+        rs = np.where( seen, digit[ pos + 4 ][ ls ], 0 )
+        special = np.where( seen, ( digit[ pos + 2 ] + ( digit[ pos + 3 ] << 4 ) )[ ls ], 0 )
+        last_rate = np.maximum.accumulate( np.where( reached_13, index, -1 ) )
+        rate = np.where( last_rate >= 0, digit[ pos + 12 ][ np.maximum( last_rate, 0 ) ], 0 )
+        dp0 = rs & 0x7
+        sign = rs & 0x8
+
+        # _adjust_dp() is applied to the stored decimal position with each complete block,
+        # count the complete blocks since the last status block (inclusive)
+        ok = ~fail
+        count = np.cumsum( ok )
+        base = np.where( seen, ( count - ok )[ ls ], 0 )
+        k = count - base
+        dp = dp0.copy()
+        for codes, delta in ( ( ( 0x06, 0x07, 0x09, 0x1C ), 1 ), ( ( 0x0D, 0x0E ), -2 ), ( ( 0x12, ), 4 ) ):
+            sel = np.isin( ctmv, codes )
+            dp[ sel ] += k[ sel ] * delta
+        dp[ ctmv == 0x0A ] = 3                          # dBV decimal is always three!
+
+        # keep only complete blocks
+        pos, status, slow, ctmv, model, rs, special, rate, dp, sign = (
+            a[ ok ] for a in ( pos, status, slow, ctmv, model, rs, special, rate, dp, sign ) )
+
+        # digits: TM1a at byte 2..6, TM1b at byte 7..11, TM2 at byte 6..11 (units first)
+        first = np.where( status, np.where( slow, 5, 6 ), 1 )
+        num_digits = np.where( slow, 6, 5 )
+        digits = digit[ ( pos + first )[ :, None ] + np.arange( 6 ) ]
+        digits[ ~slow, 5 ] = 0
+        overload = ( digits >= 10 ).any( axis = 1 )
+
+        # value as float, same as float( text )
+        mantissa = ( digits * 10 ** np.arange( 6 ) ).sum( axis = 1 )
+        exponent = num_digits - np.minimum( dp, num_digits )
+        value = mantissa / 10.0 ** exponent
+        value = np.where( sign > 0, -value, value )
+        value[ overload ] = np.nan
+
+        text = cls._format_numbers( digits, num_digits, dp, sign, overload )
+        inexact = ( exponent > 22 ) & ~overload         # 10**exponent is not exact as float
+        value[ inexact ] = [ float( t ) for t in text[ inexact ] ]
+        unit, unit_long = cls._decode_units( ctmv )
+
+        kind = np.where( status, np.where( slow, cls.FRAME_TM2, cls.FRAME_TM1B ), cls.FRAME_TM1A ).astype( np.uint8 )
+
+        return { 'pos': pos, 'kind': kind, 'text': text, 'value': value, 'overload': overload,
+                 'model': model, 'ctmv': ctmv, 'rs': rs, 'special': special, 'rate': rate,
+                 'unit': unit, 'unit_long': unit_long }
+
+
+    ######################
+    # internal functions #
+    ######################
+
+    @classmethod
+    def _select( cls, pos, end ):
+        '''Return a mask of the block candidates that are read by the state machine:
+        a candidate is skipped if it lies inside a previous selected block.
+        Iterate until stable - normally after two steps, as only start bytes of
+        fast blocks behind a TM1b block are candidates inside other blocks.'''
+        valid = np.ones( len( pos ), dtype = bool )
+        for iteration in range( cls._MAX_ITERATIONS ):
+            reach = np.maximum.accumulate( np.where( valid, end, 0 ) )
+            reach = np.concatenate( ( [ 0 ], reach[ : -1 ] ) )
+            selected = reach <= pos
+            if np.array_equal( selected, valid ):
+                return valid
+            valid = selected
+        # long chains of overlapping candidates (garbage data), go step by step
+        valid[ : ] = False
+        reach = 0
+        for n, ( p, e ) in enumerate( zip( pos.tolist(), end.tolist() ) ):
+            if p >= reach:
+                valid[ n ] = True
+                reach = e
+        return valid
+
+
+    @classmethod
+    def _format_numbers( cls, digits, num_digits, dp, sign, overload ):
+        '''Create the value strings as OpenMetra._format_number():
+        sign, for negative dp a decimal point and -dp zeros, digits (most significant first)
+        with a decimal point before digit dp'''
+        num = len( digits )
+        rows = np.arange( num )
+        has_sign = ( sign > 0 ).astype( np.int64 )
+        prefix = np.where( dp < 0, 1 - dp, 0 )          # '.000'
+        width = 8 + ( int( prefix.max() ) if num else 0 )
+        chars = np.zeros( ( num, width ), dtype = np.uint8 )
+        chars[ has_sign > 0, 0 ] = ord( '-' )
+        for z in range( width ):                        # leading decimal point and zeros
+            sel = z < prefix
+            chars[ rows[ sel ], has_sign[ sel ] + z ] = ord( '0' ) if z else ord( '.' )
+        with_dp = ( dp >= 0 ) & ( dp < num_digits )
+        chars[ rows[ with_dp ], ( has_sign + prefix + dp )[ with_dp ] ] = ord( '.' )
+        for p in range( 6 ):                            # p-th printed digit
+            sel = p < num_digits
+            col = has_sign + prefix + p + ( with_dp & ( p >= dp ) )
+            chars[ rows[ sel ], col[ sel ] ] = digits[ rows[ sel ], ( num_digits - 1 - p )[ sel ] ] + ord( '0' )
+        text = chars.view( 'S%d' % width ).ravel().astype( 'U' ).astype( object )
+        text[ overload ] = None
+        return text
+
+
+    @classmethod
+    def _decode_units( cls, ctmv ):
+        '''Unit strings as OpenMetra.decode_unit(), unknown codes give the hex value as unit
+        and keep the previous long unit'''
+        units = OpenMetra._units
+        unit_long_table = np.array( [ '' ] + units + [ '' ] * ( 256 - len( units ) ), dtype = object )
+        unit_table = np.array( [ '' ] + [ u.split( '_' )[ 0 ] for u in units ]
+                               + [ hex( c ) for c in range( len( units ), 256 ) ], dtype = object )
+        unit = unit_table[ ctmv + 1 ]                   # ctmv -1: not yet seen
+        index = np.arange( len( ctmv ) )
+        known = ctmv < len( units )
+        last_known = np.maximum.accumulate( np.where( known, index, -1 ) )
+        unit_long = np.where( last_known >= 0, unit_long_table[ ctmv[ np.maximum( last_known, 0 ) ] + 1 ], '' )
+        return unit, unit_long.astype( object )
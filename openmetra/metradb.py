@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+import os;
+import sqlite3;
+import time;
+import urllib.parse;
+
+
+class MetraDB:
+    '''SQLite time-series storage for measurements received via OpenMetra
+
+    All samples are stored in one table "samples" with absolute timestamp
+    (seconds since epoch), serial device path, measurement function, SI unit,
+    meter range and value (NULL in case of overload).
+    The table is indexed by timestamp (and by device + timestamp),
+    so a time window can be loaded without scanning the whole history.
+    Samples are collected in memory and written in batched transactions,
+    the database runs in WAL mode to allow concurrent readers (e.g. MetraPlot)
+    while a capture is running.
+    '''
+
+    #######################
+    # the class variables #
+    #######################
+
+    _db = None                  # sqlite3 connection
+    _db_file = ''               # database file name
+    _batch = []                 # samples not yet committed
+    _batch_size = 100           # commit after this number of samples ...
+    _batch_time = 1.0           # ... or after this number of seconds
+    _last_commit = 0            # time of last commit
+
+    _TIME_FORMATS = [ '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d' ]
+
+
+    #######################
+    # the class interface #
+    #######################
+
+    def __init__( self, db_file, batch_size = 100, batch_time = 1.0 ):
+        'Init internal data, e.g. the name of the database file'
+        self._db_file = db_file
+        self._batch = []
+        self._batch_size = batch_size
+        self._batch_time = batch_time
+
+
+    def __del__( self ):
+        'Close the database when last instance is deleted'
+        self.close()
+
+
+    def __enter__( self ):
+        '''Automatically called at object entry via "with"
+        Open the database and return "self" on success, "None" on error'''
+        return self.open()
+
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        'Automatically called at object exit via "with", write pending samples and clean up'
+        self.close()
+
+
+    def open( self, read_only = False ):
+        '''Open (and create if needed) the database, return "self" on success, "None" on error.
+        With "read_only" (for queries) the database must exist, it is neither created nor changed'''
+        if read_only:
+            return self._open_read_only()
+        try:
+            self._db = sqlite3.connect( self._db_file )
+            self._db.execute( 'PRAGMA journal_mode=WAL' )
+            self._db.execute( 'PRAGMA synchronous=NORMAL' )
+            with self._db:
+                self._db.execute( '''CREATE TABLE IF NOT EXISTS samples (
+                    ts REAL NOT NULL, device TEXT, function TEXT, unit TEXT, range INTEGER, value REAL )''' )
+                self._db.execute( 'CREATE INDEX IF NOT EXISTS samples_ts ON samples ( ts )' )
+                self._db.execute( 'CREATE INDEX IF NOT EXISTS samples_device_ts ON samples ( device, ts )' )
+        except sqlite3.Error:
+            self._db = None
+            return None
+        self._last_commit = time.time()
+        return self
+
+
+    def close( self ):
+        'Write all pending samples and close the database'
+        if self._db:
+            self.commit()
+            self._db.close()
+        self._db = None
+
+
+    def add( self, ts, value, device = None, function = None, unit = None, range_index = None ):
+        '''Store one sample, the value can be a number or a string as returned by
+        OpenMetra.get_measurement(), "None" marks an overload.
+        The samples are written when the batch is full or the batch time is over.'''
+        if value is not None:
+            value = float( value )
+        self._batch.append( ( ts, device, function, unit, range_index, value ) )
+        if len( self._batch ) >= self._batch_size or time.time() - self._last_commit >= self._batch_time:
+            self.commit()
+
+
+    def commit( self ):
+        'Write all pending samples in one transaction'
+        if self._batch:
+            with self._db:
+                self._db.executemany( 'INSERT INTO samples VALUES ( ?, ?, ?, ?, ?, ? )', self._batch )
+            self._batch = []
+        self._last_commit = time.time()
+
+
+    def query( self, t_from = None, t_to = None, device = None ):
+        '''Return the samples in the time window [t_from, t_to] (seconds since epoch)
+        as list of tuples (ts, device, function, unit, range, value), ordered by time.
+        Unspecified limits are open, device selects the samples of one serial device.'''
+        where = []
+        parameters = []
+        if t_from is not None:
+            where.append( 'ts >= ?' )
+            parameters.append( t_from )
+        if t_to is not None:
+            where.append( 'ts <= ?' )
+            parameters.append( t_to )
+        if device is not None:
+            where.append( 'device = ?' )
+            parameters.append( device )
+        sql = 'SELECT ts, device, function, unit, range, value FROM samples'
+        if where:
+            sql += ' WHERE ' + ' AND '.join( where )
+        sql += ' ORDER BY ts'
+        return self._db.execute( sql, parameters ).fetchall()
+
+
+    @classmethod
+    def parse_time( cls, string ):
+        '''Convert a time string into seconds since epoch, accepts either a number (epoch)
+        or local date and time, e.g. "2021-03-14 15:09:26", "2021-03-14T15:09" or "2021-03-14"'''
+        try:
+            return float( string )
+        except ValueError:
+            pass
+        for time_format in cls._TIME_FORMATS:
+            try:
+                return time.mktime( time.strptime( string, time_format ) )
+            except ValueError:
+                pass
+        raise ValueError( 'invalid time: "' + string + '"' )
+
+
+    ######################
+    # internal functions #
+    ######################
+
+    def _open_read_only( self ):
+        'Open an existing database without write access, return "self" on success, "None" on error'
+        uri = 'file:' + urllib.parse.quote( os.path.abspath( self._db_file ) ) + '?mode=ro'
+        try:
+            self._db = sqlite3.connect( uri, uri = True )
+            self._db.execute( 'SELECT 1 FROM samples LIMIT 1' ) # fails if missing, no sqlite file or no samples table
+        except sqlite3.Error:
+            if self._db:
+                self._db.close()
+            self._db = None
+            return None
+        return self
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+import csv;
+import itertools;
+
+
+class MetraFile:
+    '''Format of data files written by the program Metra
+
+    Format: no header, values are SI units s and V, separated either by space or comma,
+    e.g. "u.u", "u.u V", "t.t u.u" or "t.t s u.u V" (power: followed by voltage and current).
+    The format is auto-detected from one line of the file,
+    detect also "german" csv (comma as decimal separator and semicolon as field separator).
+    '''
+
+    #######################
+    # the class variables #
+    #######################
+
+    delim = ' '                 # field separator
+    dec_sep = '.'               # decimal separator
+    num_elements = 0            # number of fields of a complete row
+    time_index = None           # field of timestamp, None: no timestamp
+    time_unit = None            # unit of timestamp, None: not printed
+    data_index = None           # field of (first) value
+    data_unit = None            # unit of (first) value, None: not printed
+
+
+    #######################
+    # the class interface #
+    #######################
+
+    def __init__( self, one_line ):
+        'Detect the format of the data from one line'
+        one_line = one_line.rstrip( '\n' )
+        # data file or csv file?
+        if ',' in one_line and '.' in one_line: # csv
+            self.delim = ','
+        elif ';' in one_line:   # german csv
+            self.delim = ';'
+        else:                   # data file
+            self.delim = ' '
+        elements = one_line.split( self.delim )
+        self.num_elements = len( elements )
+        self.dec_sep = '.'
+        num_values = one_line.count( self.dec_sep )
+        if 0 == num_values and ',' != self.delim:    # german data or csv
+            self.dec_sep = ','
+            num_values = one_line.count( self.dec_sep )
+        if self.num_elements >= 4:   # "t.t 's' u.u 'V'"
+            self.time_index = 0
+            self.time_unit = elements[1]
+            self.data_index = 2
+            self.data_unit = elements[3]
+        elif self.num_elements >= 2:
+            if num_values == 1: # "u.u 'V'"
+                self.data_index = 0
+                self.data_unit = elements[1]
+            else:               # "t.t u.u"
+                self.time_index = 0
+                self.data_index = 1
+        else:                   # "u.u"
+            self.data_index = 0
+
+
+    @classmethod
+    def detect( cls, infile ):
+        '''Detect the format from the first line with a value of the (seekable) file and rewind the input,
+        leading overload lines ("None") do not show the decimal separator'''
+        first_line = one_line = infile.readline()   # get one line
+        while 'None' in one_line:                   # overload, try next line
+            one_line = infile.readline()
+        infile.seek( 0 )                            # and rewind the input
+        return cls( one_line or first_line )
+
+
+    def reader( self, infile ):
+        'Return a csv reader for the rows of the file'
+        return csv.reader( infile, delimiter=self.delim )
+
+
+    def chunks( self, infile, chunk_size = 10000 ):
+        'Read the file in chunks of rows without loading it completely, yield lists of rows'
+        rows = self.reader( infile )
+        while True:
+            chunk = list( itertools.islice( rows, chunk_size ) )
+            if not chunk:
+                return
+            yield chunk
+
+
+    def get_number( self, string ):
+        'Convert one field into a float, "None" (overload) returns None'
+        if 'None' == string:
+            return None
+        if '.' != self.dec_sep:  # german data
+            string = string.replace( self.dec_sep, '.' )
+        return float( string )
+
+
+    def get_time( self, row ):
+        'Return the timestamp of the row or None'
+        if self.time_index is None:
+            return None
+        return self.get_number( row[ self.time_index ] )
+
+
+    def get_values( self, row ):
+        '''Return all values of the row as list of tuples (value, unit), the unit is None if not printed,
+        power rows contain also voltage and current, an incomplete row returns an empty list'''
+        if len( row ) < self.num_elements or self.data_index is None:
+            return []
+        if self.data_unit is None:
+            return [ ( self.get_number( row[ self.data_index ] ), None ) ]
+        values = []
+        for index in range( self.data_index, len( row ) - 1, 2 ):
+            try:
+                values.append( ( self.get_number( row[ index ] ), row[ index + 1 ] ) )
+            except ValueError: # e.g. verbose debug output
+                break
+        return values
+
+
+    @classmethod
+    def summarize( cls, filename, chunk_size = 10000 ):
+        '''Read one file in chunks and return a summary dict
+        { 'file', 'format', 'rows', 'first', 'last', 'units': { unit: { 'count', 'overload', 'min', 'max', 'sum' } }, 'error' }
+        with time range and statistics per unit, unknown unit is "".
+        The function is a class member so that it can be used in a multiprocessing pool'''
+        summary = { 'file': filename, 'format': '', 'rows': 0, 'first': None, 'last': None, 'units': {}, 'error': None }
+        units = summary[ 'units' ]
+        try:
+            with open( filename ) as infile:
+                mf = cls.detect( infile )
+                summary[ 'format' ] = str( mf )
+                for chunk in mf.chunks( infile, chunk_size ):
+                    summary[ 'rows' ] += len( chunk )
+                    for row in chunk:
+                        values = mf.get_values( row )
+                        if not values: # incomplete row
+                            continue
+                        if mf.time_index is not None:
+                            t = mf.get_time( row )
+                            if summary[ 'first' ] is None:
+                                summary[ 'first' ] = t
+                            summary[ 'last' ] = t
+                        for value, unit in values:
+                            stat = units.get( unit or '' )
+                            if stat is None:
+                                stat = units[ unit or '' ] = { 'count': 0, 'overload': 0, 'min': None, 'max': None, 'sum': 0.0 }
+                            if value is None:
+                                stat[ 'overload' ] += 1
+                                continue
+                            if stat[ 'count' ]:
+                                if value < stat[ 'min' ]:
+                                    stat[ 'min' ] = value
+                                elif value > stat[ 'max' ]:
+                                    stat[ 'max' ] = value
+                            else:
+                                stat[ 'min' ] = stat[ 'max' ] = value
+                            stat[ 'count' ] += 1
+                            stat[ 'sum' ] += value
+        except ( OSError, ValueError, UnicodeDecodeError, csv.Error ) as e:
+            summary[ 'error' ] = str( e )
+        return summary
+
+
+    @classmethod
+    def merge( cls, total, summary ):
+        'Add the statistics of one summary (as returned by "summarize") to the total, return total'
+        total[ 'rows' ] += summary[ 'rows' ]
+        for unit, stat in summary[ 'units' ].items():
+            acc = total[ 'units' ].get( unit )
+            if acc is None:
+                total[ 'units' ][ unit ] = dict( stat )
+                continue
+            if stat[ 'count' ]:
+                if not acc[ 'count' ] or stat[ 'min' ] < acc[ 'min' ]:
+                    acc[ 'min' ] = stat[ 'min' ]
+                if not acc[ 'count' ] or stat[ 'max' ] > acc[ 'max' ]:
+                    acc[ 'max' ] = stat[ 'max' ]
+            acc[ 'count' ] += stat[ 'count' ]
+            acc[ 'overload' ] += stat[ 'overload' ]
+            acc[ 'sum' ] += stat[ 'sum' ]
+        return total
+
+
+    def __str__( self ):
+        if self.dec_sep == ',':
+            name = 'german '
+        else:
+            name = ''
+        if self.delim == ' ':
+            name += 'data'
+        else:
+            name += 'csv'
+        if self.time_index is not None:
+            name += ', time'
+        if self.data_unit is not None:
+            name += ', unit'
+        return name
@@ -5,10 +5,18 @@
 VERSION = '0.3.1'
 
 
+import json;
+import os;
 import serial;
 import sys;
+import tempfile;
 import time;
 
+try:
+    import fcntl;               # lock for the warm start cache (not available on Windows)
+except ImportError:
+    fcntl = None
+
 
 class OpenMetra:
     '''Gossen METRAHit 29s data transfer via BD232 interface
@@ -146,6 +154,17 @@ class OpenMetra:
     _value = ''                 # value string
     _rate = 0                   # measurement rate
     _verbose = 0                # debugging level
+    _state_cache = None         # file name of warm start cache, None: disabled
+    _state = None               # last known settings (model, ctmv, range, rate) as stored in cache
+    _warm_start = False         # settings were taken from cache and are not yet confirmed by the meter
+    _state_saved = False        # settings were written to the cache in this session
+    _state_dirty = False        # settings changed since last write, written at close()
+    _reconnect = False          # reopen the device on read errors instead of exit
+    _stable_device = None       # /dev/serial/by-id path of serial device (stable over USB reconnect)
+    _rate_index = None          # rate as set by set_rate(), restored after reconnect
+    _send_mode = False          # send mode was set by set_mode(), restored after reconnect
+    _gap = None                 # (start, end) time of last interruption, not yet fetched by get_gap()
+    _reconnect_delay = 1        # wait time (s) before next reopen, doubled up to 60 s until a block is decoded
 
     _units = ['', 'V_DC', 'V_ACDC', 'V_AC',             # 0x00 .. 0x03
         'mA_DC', 'mA_ACDC', 'A_DC', 'A_ACDC',           # 0x04 .. 0x07
@@ -162,6 +181,13 @@ class OpenMetra:
     CMD_FUNCTION = 7
     CMD_MEASURE = 8
 
+    # power mode functions (W, and mA, A, V in power mode) are not cached
+    _POWER_FUNCTIONS = ( 0x0D, 0x0E, 0x1B, 0x1C, 0x1D )
+
+    # default location of the warm start cache
+    STATE_CACHE = os.path.join( os.environ.get( 'XDG_CACHE_HOME', os.path.expanduser( '~/.cache' ) ),
+        'openmetra', 'state.json' )
+
     MODE_NORMAL = 0
     MODE_SEND = 1
     MODE_OFF = 5
@@ -173,11 +199,18 @@ class OpenMetra:
     # the class interface #
     #######################
 
-    def __init__( self, serial_device = '/dev/ttyUSB0', timeout = 10, known_devices = [ METRAHIT28S, METRAHIT29S ] ):
-        'Init internal data, e.g. the name of serial device'
+    def __init__( self, serial_device = '/dev/ttyUSB0', timeout = 10, known_devices = [ METRAHIT28S, METRAHIT29S ],
+                  state_cache = None, reconnect = False ):
+        '''Init internal data, e.g. the name of serial device
+        With state_cache (e.g. OpenMetra.STATE_CACHE) the last seen settings of the meter are
+        stored per serial device and used at the next start until the meter sends its settings.
+        With reconnect a read timeout or error does not exit the program, the device is reopened
+        and the meter is set up again until the data transfer continues'''
         self._serial_device = serial_device
         self._known_devices = known_devices
         self._timeout = timeout
+        self._state_cache = state_cache
+        self._reconnect = reconnect
 
 
     def __del__( self ):
@@ -198,20 +231,20 @@ class OpenMetra:
 
     def open( self, timeout=10 ):
         '''Open the serial connection and return "self" on success, "None" on error'''
-        try:
-            # open connection to BD232 interface
-            # do not use bytesize=6, use 8 bit and mask received values with 0x3F
-            # PL2303 supports 5,6,7,8 bit, ft232 supports only 7 or 8 bit
-            self._BD232 = serial.Serial( self._serial_device, baudrate = 9600, timeout = timeout, exclusive=True )
-        except:
+        if not self._open_device( self._serial_device, timeout ):
             return None
-        else:
-            self.wakeup()
+        self.wakeup()
+        if self._reconnect:
+            self._stable_device = self._find_stable_device()
+        if self._state_cache:
+            self.load_state()
         return self
 
 
     def close( self ):
-        'Close the connection to the meter, i.e. the serial object'
+        'Close the connection to the meter, i.e. the serial object, store changed settings in cache'
+        if self._state_dirty:
+            self._save_state()
         if self._BD232:
             self._BD232.close()
         self._BD232 = None
@@ -234,20 +267,67 @@ class OpenMetra:
         self._BD232.timeout = timeout
 
 
+    def set_reconnect( self, reconnect=True ):
+        'Reopen the device on read timeout or error (True) or exit the program (False)'
+        self._reconnect = reconnect
+        if reconnect and self._stable_device is None:
+            self._stable_device = self._find_stable_device()
+
+
+    def get_gap( self ):
+        '''Return the time (start, end) of the last interruption caused by a reconnect
+        and clear it, return None if the data transfer was not interrupted since last call'''
+        gap = self._gap
+        self._gap = None
+        return gap
+
+
     def set_verbose( self, verbose ):
         'Set the verbosity level for debugging'
         self._verbose = verbose
 
 
+    def load_state( self ):
+        '''Preset model, measurement function, range and rate from the warm start cache,
+        so that fast mode values get their unit immediately (instead of up to 500 ms later).
+        The settings are checked against the first status block sent by the meter.
+        Return True if cached settings for this serial device were found'''
+        try:
+            with open( self._state_cache ) as cache:
+                state = json.load( cache ).get( self._serial_device )
+            model, ctmv, rs, rate = state[ 'model' ], state[ 'ctmv' ], state[ 'rs' ], state[ 'rate' ]
+            if not all( isinstance( v, int ) and not isinstance( v, bool ) for v in ( model, ctmv, rs, rate ) ):
+                return False
+        except ( OSError, ValueError, AttributeError, TypeError, KeyError ):
+            return False
+        if model not in self._known_devices or ctmv not in range( len( self._units ) ) or rs not in range( 8 ):
+            return False
+        self._state = state
+        self._model = model
+        self._ctmv = ctmv
+        self._rs = rs
+        self._dp = rs
+        self._sign = 0                                  # the sign is not cached
+        self._rate = rate
+        self._warm_start = True
+        self.decode_unit()
+        if self._verbose:
+            print( 'Warm start:', hex( model ), self._unit_long, self.get_rs_string(), file=sys.stderr )
+        return True
+
+
     def get_measurement( self, format_value=False ):
         'Wait for one measurement and return the value as string'
         # wait for start condition
         while not self._start_detected():
             pass
-        if format_value:
-            return str( float( self._get_value() ) )
+        value = self._get_value()
+        if value is not False: # the meter is alive, next reconnect starts with short delay
+            self._reconnect_delay = 1
+        if format_value and value: # keep False (incomplete block) and None (overload)
+            return str( float( value ) )
         else:
-            return self._get_value()
+            return value
 
 
     def get_unit( self ):
@@ -260,6 +340,13 @@ class OpenMetra:
         return self._unit_long
 
 
+    def get_range( self ):
+        'Return the range index (position of decimal point as sent by the meter) of last measurement, "None" if not yet seen'
+        if self._ctmv is None: # not yet seen (fast mode)
+            return None
+        return self._rs & 0x07
+
+
     def get_special_string( self ):
         'Return the status bits as string'
         return self._decode_special()
@@ -326,6 +413,7 @@ class OpenMetra:
     def set_mode( self, mode ):
         '''Set the measurement mode, e.g. "Normal", "Send", "On", "Off", "Reset"
         In case of switching into send mode the multimeter does not send any response.'''
+        self._send_mode = mode == self.MODE_SEND
         self.send_command( self.CMD_MODE, mode, mode )
 
 
@@ -336,6 +424,7 @@ class OpenMetra:
         ]
         if rate_index >= len( rates ): # invalid, set default 1 second
             rate_index = 4
+        self._rate_index = rate_index
         self.send_command( 4, 2, rate_index + 5 )
         rate = rates[ rate_index ]
         if rate_index > 6: # > 5 s
@@ -458,12 +547,68 @@ class OpenMetra:
         if self._verbose > 3:
             print( 'DIGITS:', self._digits )
 
+        if self._state_cache and self._start < 0x10:  # got the settings from the meter
+            self._check_state()
+
         self.decode_unit()
         self._adjust_dp()
         self._format_number()
         return self._value
 
 
+    def _check_state( self ):
+        '''Validate the cached settings with the received ones.
+        The cache is written at once for the first settings seen (or if the cached ones were wrong),
+        later changes are written at close()'''
+        if self._ctmv in self._POWER_FUNCTIONS: # cycles through W, V, A - nothing to gain for fast mode
+            self._warm_start = False
+            return
+        state = { 'model': self._model, 'ctmv': self._ctmv, 'rs': self._rs & 0x07, 'rate': self._rate }
+        if state == self._state:
+            self._warm_start = False
+            return
+        if self._warm_start and self._verbose:
+            print( 'Warm start: cached settings invalid', file=sys.stderr )
+        self._state = state
+        if self._warm_start or not self._state_saved:
+            self._save_state()
+        else:
+            self._state_dirty = True
+        self._warm_start = False
+
+
+    def _save_state( self ):
+        '''Store the settings for this serial device in the warm start cache, keep other devices.
+        Read, update and replace the cache under a file lock, as several instances
+        (threads or processes, one per serial device) can share the cache'''
+        self._state_dirty = False
+        cache_dir = os.path.dirname( self._state_cache ) or '.'
+        try:
+            os.makedirs( cache_dir, exist_ok = True )
+            with open( self._state_cache + '.lock', 'w' ) as lock:
+                if fcntl:
+                    fcntl.flock( lock, fcntl.LOCK_EX ) # released when the lock file is closed
+                try:
+                    with open( self._state_cache ) as cache:
+                        states = json.load( cache )
+                    if not isinstance( states, dict ):
+                        states = {}
+                except ( OSError, ValueError ):
+                    states = {}
+                states[ self._serial_device ] = self._state
+                handle, temp_file = tempfile.mkstemp( dir = cache_dir, prefix = '.state.' )
+                try:
+                    with os.fdopen( handle, 'w' ) as cache:
+                        json.dump( states, cache )
+                    os.replace( temp_file, self._state_cache ) # atomic, readers see old or new cache
+                except BaseException:
+                    os.unlink( temp_file )
+                    raise
+            self._state_saved = True
+        except OSError as e:
+            print( 'Warm start cache error:', e, file=sys.stderr )
+
+
     def _start_detected( self ):
         'Check for start condition 0x0E or 0x1x'
         self._start = self._get_byte()
@@ -472,19 +617,85 @@ class OpenMetra:
 
 
     def _get_byte( self ):
-        'Wait for next byte (2 MSB = 0) with timeout'
+        '''Wait for next byte (2 MSB = 0) with timeout
+        On timeout or error exit the program - or reconnect and return 0x00,
+        flagged as unexpected start, so that the interrupted block is dropped'''
         try:
             byte = self._BD232.read()
-            if not len( byte ):
-                sys.stderr.write( 'Timeout (Enable transfer: hold down "DATA/CLEAR" while switching on)\n' )
-                sys.exit()
-            byte = ord( byte ) & 0x3F
-            if self._verbose > 4:
-                print( '_get_byte', hex( byte ) )
-            return byte
+            if len( byte ):
+                byte = ord( byte ) & 0x3F
+                if self._verbose > 4:
+                    print( '_get_byte', hex( byte ) )
+                return byte
+            error = 'Timeout (Enable transfer: hold down "DATA/CLEAR" while switching on)'
         except Exception as e:
-            print( 'Error:', e, file=sys.stderr )
+            error = 'Error: ' + str( e )
+        print( error, file=sys.stderr )
+        if not self._reconnect:
             sys.exit()
+        self._resume()
+        self._unexpected_start = True
+        return 0
+
+
+    def _open_device( self, device, timeout ):
+        'Open the serial device, return True on success'
+        try:
+            # open connection to BD232 interface
+            # do not use bytesize=6, use 8 bit and mask received values with 0x3F
+            # PL2303 supports 5,6,7,8 bit, ft232 supports only 7 or 8 bit
+            self._BD232 = serial.Serial( device, baudrate = 9600, timeout = timeout, exclusive=True )
+        except Exception:
+            self._BD232 = None
+            return False
+        return True
+
+
+    def _find_stable_device( self ):
+        'Return the /dev/serial/by-id link of the serial device, it survives USB re-enumeration'
+        by_id = '/dev/serial/by-id'
+        try:
+            device = os.path.realpath( self._serial_device )
+            for name in sorted( os.listdir( by_id ) ):
+                link = os.path.join( by_id, name )
+                if os.path.realpath( link ) == device:
+                    return link
+        except OSError: # not linux or no USB serial device
+            pass
+        return None
+
+
+    def _resume( self ):
+        '''Reopen the device (also if it comes back with another name) with increasing delay,
+        switch the meter on and restore rate and send mode, remember the gap'''
+        if self._gap:                                   # not yet fetched, extend it
+            gap_start = self._gap[ 0 ]
+        else:
+            gap_start = time.time()
+        timeout = self._BD232.timeout if self._BD232 else self._timeout
+        while True:
+            self.close()
+            # the delay is kept over reconnects without decoded data, e.g. meter switched off
+            time.sleep( self._reconnect_delay )
+            self._reconnect_delay = min( 2 * self._reconnect_delay, 60 )
+            for device in ( self._stable_device, self._serial_device ):
+                if device and self._open_device( device, timeout ):
+                    break
+            else:
+                continue
+            try:
+                self.wakeup()
+                if self._rate_index is not None:
+                    self.set_rate( self._rate_index )
+                if self._send_mode:
+                    self.set_mode( self.MODE_SEND )
+            except Exception as e: # device lost again
+                if self._verbose:
+                    print( 'Error:', e, file=sys.stderr )
+                continue
+            break
+        self._gap = ( gap_start, time.time() )
+        print( 'Reconnected after', round( self._gap[ 1 ] - gap_start, 1 ), 's', file=sys.stderr )
 
     def _get_digit( self ):
         'Get one digit (4 MSB = 0)'